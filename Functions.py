@@ -1,3 +1,4 @@
+import os
 import torch
 from torch import autograd
 from torch import nn
@@ -7,6 +8,18 @@ import torchvision.transforms as transforms
 from tqdm.notebook import tqdm
 import numpy as np
 import torch.nn.functional as F
+import torch.nn.grad
+
+# check loss gradients for nan on every backward, costs a device sync per step;
+# enable with DEBUG_NAN=1 in the environment
+DEBUG = os.environ.get("DEBUG_NAN", "0").strip().lower() not in ("", "0", "false", "no", "off")
+
+# the S outputs of forward are only placeholders for their gradients, so they are
+# served as a read-only stride-0 view of a single one (not torch.ones_like: it can't
+# be modified in place). No module-level cache, filling it inside a
+# torch.compile trace leaks a graph intermediate
+def ones_placeholder(x):
+    return x.new_ones(()).expand_as(x)
 
 class BackPool(autograd.Function):
 
@@ -31,11 +44,15 @@ class TimesFunction(autograd.Function):
     @staticmethod
     def forward(ctx, x, xS, a):
         ctx.a = a
-        return x * a, torch.ones_like(x)
+        # grad_outputS is never read, don't let autograd zero-fill it
+        ctx.set_materialize_grads(False)
+        return x * a, ones_placeholder(x)
 
     # This function has only a single output, so it gets only one gradient
     @staticmethod
     def backward(ctx, grad_output, grad_outputS):
+        if grad_output is None:
+            return None, None, None
 
         grad_x = grad_output * ctx.a
         grad_xS = grad_output * (ctx.a ** 2)
@@ -55,7 +72,7 @@ class SLinearFunction(autograd.Function):
         # if bias is not None:
         #     output += bias.unsqueeze(0).expand_as(output)
         output = F.linear(input, weight, bias)
-        return output, torch.ones_like(output)#outputS
+        return output, ones_placeholder(output)#outputS
 
     # This function has only a single output, so it gets only one gradient
     @staticmethod
@@ -82,7 +99,7 @@ class SLinearFunction(autograd.Function):
         if ctx.needs_input_grad[3]:
             grad_weightS = grad_outputS.t().mm(input**2)
         if bias is not None and ctx.needs_input_grad[4]:
-            grad_bias = grad_output.sum(0)
+            grad_bias = grad_output.sum(0, dtype=torch.promote_types(grad_output.dtype, torch.float32))
 
         return grad_input, grad_inputS, grad_weight, grad_weightS, grad_bias
 
@@ -100,105 +117,75 @@ class SConv2dFunction(autograd.Function):
         # conv_out = F.fold(conv_out, (ow, oh), (1,1))
         # ctx.save_for_backward(col_image, weight, bias)
         conv_out = F.conv2d(input, weight, bias, stride, padding, dilation, groups)
-        padding = padding[0]
-        padded_input = F.pad(input,tuple(4*[padding]))
         ctx.stride = stride
+        ctx.dilation = dilation
         ctx.groups = groups
-        ctx.save_for_backward(padded_input, weight, bias, torch.IntTensor([padding]).to(padded_input.device))
-        return conv_out, torch.ones_like(conv_out)
+        ctx.padding = padding
+        ctx.set_materialize_grads(False)
+        ctx.save_for_backward(input, weight, bias)
+        return conv_out, ones_placeholder(conv_out)
     
     @staticmethod
-    def backward(ctx, grad_output_ori, grad_outputS_ori):
-        input_ori, weight_ori, bias, padding = ctx.saved_tensors
+    def backward(ctx, grad_output, grad_outputS):
+        input, weight, bias = ctx.saved_tensors
         stride = ctx.stride
-        o_size = grad_output_ori.shape
-        new_o = torch.zeros(o_size[0], o_size[1], o_size[2] * stride[0], o_size[3] * stride[1]).to(grad_output_ori.device)
-        new_o[:,:,::stride[0],::stride[1]] = grad_output_ori
-        new_oS = torch.zeros(o_size[0], o_size[1], o_size[2] * stride[0], o_size[3] * stride[1]).to(grad_outputS_ori.device)
-        new_oS[:,:,::stride[0],::stride[1]] = grad_outputS_ori
-        grad_output_ori = new_o
-        grad_outputS_ori = new_oS
-        
-        oc, ic, kw, kh = weight_ori.shape
-        block_o = oc // ctx.groups
-        block_i = ic
-        grad_w = []
-        grad_wS = []
-        grad_b = []
-        grad_i = []
-        grad_iS = []
-        for i in range(ctx.groups):
-            weight = weight_ori[block_o*i:block_o*(i+1),:,:,:]
-            input = input_ori[:,block_i*i:block_i*(i+1),:,:]
-            grad_output = grad_output_ori[:,block_o*i:block_o*(i+1),:,:]
-            grad_outputS = grad_outputS_ori[:,block_o*i:block_o*(i+1),:,:]
-
-            oc, ic, kw, kh = weight.shape
-            col_image = F.unfold(input,(kw,kh)).transpose(1,2)
-            bs, channels, ow, oh = grad_output.shape
-            
-            # col_grad_output = grad_output.view(bs, channels, -1)
-            grad_w.append(grad_output.view(bs, channels, -1).bmm(col_image).sum(dim=0).view(weight.shape))
-            grad_wS.append(grad_outputS.view(bs, channels, -1).bmm(col_image**2).sum(dim=0).view(weight.shape)) # SSSS
-
-            if bias is None:
-                grad_b = None
-            else:
-                grad_b.append(grad_output.sum(axis=[0,2,3]))
-
-            grad_output_padded = F.pad(grad_output,tuple(4*[kw-1-padding.item()]))
-            col_grad = F.unfold(grad_output_padded,(kh,kw)).transpose(1,2)
-            grad_outputS_padded = F.pad(grad_outputS,tuple(4*[kw-1-padding.item()])) # SSSS
-            col_gradS = F.unfold(grad_outputS_padded,(kh,kw)).transpose(1,2)
-            
-            flipped_w = weight.flip([2,3]).swapaxes(0,1)
-            col_flip = flipped_w.reshape(flipped_w.size(0),-1)
-            grad_i_this = col_grad.matmul(col_flip.t()).transpose(1,2)
-            grad_i.append(F.fold(grad_i_this, (ow, oh), (1,1)))
-            grad_iS_this  = col_gradS.matmul(col_flip.t() ** 2).transpose(1,2)
-            grad_iS.append(F.fold(grad_iS_this, (ow, oh), (1,1)))
-        
-        grad_w = torch.cat(grad_w, dim=0)
-        grad_wS = torch.cat(grad_wS, dim=0)
-        grad_i = torch.cat(grad_i, dim=1)
-        grad_iS = torch.cat(grad_iS, dim=1)
-        if bias is not None:
-            grad_b = torch.cat(grad_b, dim=0)
+        dilation = ctx.dilation
+        groups = ctx.groups
+        padding = ctx.padding
+        # grads are not materialized, an unused output arrives as None
+        grad_i = grad_iS = grad_w = grad_wS = grad_b = None
+
+        if grad_output is not None and ctx.needs_input_grad[2]:
+            grad_w = torch.nn.grad.conv2d_weight(input, weight.shape, grad_output, stride, padding, dilation, groups)
+        if grad_outputS is not None and ctx.needs_input_grad[3]:
+            grad_wS = torch.nn.grad.conv2d_weight(input ** 2, weight.shape, grad_outputS, stride, padding, dilation, groups) # SSSS
+
+        if grad_output is not None and bias is not None and ctx.needs_input_grad[4]:
+            grad_b = grad_output.sum(dim=(0,2,3), dtype=torch.promote_types(grad_output.dtype, torch.float32))
+
+        if grad_output is not None and ctx.needs_input_grad[0]:
+            grad_i = torch.nn.grad.conv2d_input(input.shape, weight, grad_output, stride, padding, dilation, groups)
+        if grad_outputS is not None and ctx.needs_input_grad[1]:
+            grad_iS = torch.nn.grad.conv2d_input(input.shape, weight ** 2, grad_outputS, stride, padding, dilation, groups)
 
         return grad_i, grad_iS, grad_w, grad_wS, grad_b, None, None, None, None
 
 
+def bn_backward(input, grad_output, grad_outputS, running_mean, inv_skr, scale, scale_sq, affine):
+    # pointwise body of the BN backward, works on the per-channel factors
+    # saved by forward so no sqrt/div is recomputed here
+    shape = [1, -1, 1, 1]
+    grad_weight = None
+    if affine:
+        grad_weight = ((input - running_mean.view(shape)) * inv_skr.view(shape)).sum(dim=[0, 2, 3], dtype=torch.promote_types(input.dtype, torch.float32))
+    # the per-channel factors are cast down so the elementwise pass runs in the grad dtype
+    grad_input = grad_output * scale.view(shape).to(grad_output.dtype)
+    grad_inputS = grad_outputS * scale_sq.view(shape).to(grad_outputS.dtype)
+    return grad_input, grad_inputS, grad_weight
+
 class SBatchNorm2dFunction(autograd.Function):
     @staticmethod
     # bias is an optional argument
     def forward(ctx, input, inputS, running_mean, running_var, weight=None, bias=None, training=False, momentum=0.1, eps=1e-05):
         function = torch.nn.functional.batch_norm
         output = function(input, running_mean, running_var, weight, bias, training, momentum, eps)
-        ctx.save_for_backward(input, running_mean, running_var, weight, bias, torch.Tensor([eps]).to(weight.device))
-        return output, torch.ones_like(output)
+        # per-channel factors used by backward, computed once here on the small
+        # running stats instead of on every backward
+        inv_skr = torch.rsqrt(running_var + eps)
+        scale = inv_skr if weight is None else weight * inv_skr
+        ctx.affine = weight is not None
+        ctx.save_for_backward(input, running_mean, inv_skr, scale, scale * scale, bias)
+        return output, ones_placeholder(output)
 
     @staticmethod
     def backward(ctx, grad_output, grad_outputS):
         
-        input, running_mean, running_var, weight, bias, eps = ctx.saved_tensors
-        running_mean = running_mean.view(1,-1,1,1)
-        running_var = running_var.view(1,-1,1,1)
-        weight = weight.view(1,-1,1,1)
-        skr = torch.sqrt(running_var + eps)
-        if weight is not None:
-            grad_weight = ((input - running_mean) / skr).sum(dim=[0,2,3])
-        else:
-            weight = 1
-            grad_weight = None
+        input, running_mean, inv_skr, scale, scale_sq, bias = ctx.saved_tensors
+        grad_input, grad_inputS, grad_weight = bn_backward(input, grad_output, grad_outputS, running_mean, inv_skr, scale, scale_sq, ctx.affine)
         if bias is not None:
-            grad_bias = grad_output.sum(axis=[0,2,3])
+            grad_bias = grad_output.sum(dim=[0,2,3], dtype=torch.promote_types(grad_output.dtype, torch.float32))
         else:
-            bias = 0
             grad_bias = None
-        grad_input = grad_output * weight / skr
-        grad_inputS = grad_outputS * ((weight / skr) ** 2)
-        # grad_inputS = grad_outputS * ((weight **2 / skr))
-        
 
         return grad_input, grad_inputS, None, None, grad_weight, grad_bias, None, None, None
 
@@ -238,19 +225,30 @@ class SMSEFunction(autograd.Function):
         return grad_input, torch.ones_like(grad_input) * 2, None, None, None, None
 
 def is_nan(x):
-    return torch.isnan(x).sum() != 0
+    return torch.isnan(x).any()
 
 def nan_print(x):
     x = x.tolist()
     for i in x:
         print(i)
 
-def test_nan(exp, exp_sum, g_input, g_inputS, ratio):
-    if is_nan(g_input) or is_nan(g_inputS):
-        torch.save([exp.cpu().numpy(), exp_sum.cpu().numpy()], "debug.pt")
+def test_nan(input, g_input, g_inputS, ratio):
+    # one combined flag so the clean path costs a single device sync
+    if (is_nan(g_input) | is_nan(g_inputS)).item():
+        torch.save([input.cpu().numpy(), ratio.cpu().numpy()], "debug.pt")
         print(is_nan(g_input), is_nan(g_inputS))
         raise Exception
 
+def ce_backward(input, target):
+    # gradients of the CE loss for both branches, grad_inputS is the diagonal
+    # of the softmax jacobian
+    ratio = F.softmax(input, dim=1)
+
+    grad_input_mask = F.one_hot(target, num_classes=input.size(1)).to(input.dtype)
+    grad_input = (ratio - grad_input_mask) / input.size(0)
+    grad_inputS = (1 - ratio) * ratio
+    return grad_input, grad_inputS, ratio
+
 class SCrossEntropyLossFunction(autograd.Function):
     @staticmethod
     # bias is an optional argument
@@ -268,22 +266,11 @@ class SCrossEntropyLossFunction(autograd.Function):
         # None. Thanks to the fact that additional trailing Nones are
         # ignored, the return statement is simple even when the function has
         # optional inputs.
-        eps = pow(2,-10)
         input, target = ctx.saved_tensors
 
-        the_max = torch.max(input, dim=1)[0].unsqueeze(1).expand_as(input)
-        exp = torch.exp(input - the_max)
-        exp_sum = exp.sum(dim=1).unsqueeze(1).expand_as(input)
-        ratio = exp / exp_sum
-
-        grad_input_mask = torch.zeros_like(input)
-        l_index = torch.LongTensor(range(len(input))).to(grad_input_mask.device)
-        grad_input_mask[l_index, target] = 1
-        grad_input = (ratio - grad_input_mask)/len(input)
-        # grad_inputS = (exp_sum - exp) * exp / (exp_sum ** 2)
-        # grad_input = (ratio - grad_input_mask)/len(input)
-        grad_inputS = (1 - ratio) * ratio
+        grad_input, grad_inputS, ratio = ce_backward(input, target)
         
-        test_nan(exp, exp_sum, grad_input, grad_inputS, ratio)
+        if DEBUG:
+            test_nan(input, grad_input, grad_inputS, ratio)
 
         return grad_input, grad_inputS, None, None, None, None, None, None
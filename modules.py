@@ -3,12 +3,23 @@ from torch import nn
 from torch import functional
 from torch._C import device
 from torch.nn.modules.pooling import MaxPool2d
-from Functions import SLinearFunction, SConv2dFunction, SMSEFunction, SCrossEntropyLossFunction, SBatchNorm2dFunction, TimesFunction
+from Functions import SLinearFunction, SConv2dFunction, SMSEFunction, SCrossEntropyLossFunction, SBatchNorm2dFunction, TimesFunction, ones_placeholder
 import numpy as np
 
+def cast_placeholder(xS, x):
+    # xS values are never read, only its gradient path matters: without one it is
+    # swapped for a stride-0 ones view instead of being cast into a full tensor.
+    # FakeSModule layers pass xS=None, which is handed on unchanged
+    if xS is None or xS.dtype == x.dtype:
+        return xS
+    if not xS.requires_grad:
+        return ones_placeholder(x)
+    return xS.to(x.dtype)
+
 class SModule(nn.Module):
-    def __init__(self):
+    def __init__(self, compute_dtype=None):
         super().__init__()
+        self.compute_dtype = compute_dtype
     
     def create_helper(self):
         self.weightS = nn.Parameter(torch.ones(self.op.weight.size()).requires_grad_())
@@ -17,6 +28,15 @@ class SModule(nn.Module):
         self.original_w = None
         self.original_b = None
         self.scale = 1.0
+
+    def to_compute(self, x, xS, weight, weightS):
+        # run the S function in compute_dtype (e.g. torch.bfloat16), autograd casts
+        # the weight gradients back. The caller casts x back to its entry dtype
+        if self.compute_dtype is None:
+            return x, xS, weight, weightS
+        x = x.to(self.compute_dtype)
+        xS = cast_placeholder(xS, x)
+        return x, xS, weight.to(self.compute_dtype), weightS.to(self.compute_dtype)
     
     def set_noise(self, dev_var, write_var, N, m):
         # N: number of bits per weight, m: number of bits per device
@@ -145,15 +165,15 @@ class SModule(nn.Module):
         #     self.op.bias.data = self.op.bias.data / scale
 
 class SLinear(SModule):
-    def __init__(self, in_features, out_features, bias=True):
-        super().__init__()
+    def __init__(self, in_features, out_features, bias=True, compute_dtype=None):
+        super().__init__(compute_dtype)
         self.op = nn.Linear(in_features, out_features, bias)
         self.create_helper()
         self.function = SLinearFunction.apply
         self.times_function = TimesFunction.apply
     
     def copy_N(self):
-        new = NLinear(self.op.in_features, self.op.out_features, False if self.op.bias is None else True)
+        new = NLinear(self.op.in_features, self.op.out_features, False if self.op.bias is None else True, self.compute_dtype)
         new.op = self.op
         new.noise = self.noise
         new.mask = self.mask
@@ -162,24 +182,27 @@ class SLinear(SModule):
     def forward(self, xC):
         x, xS = xC
         # x, xS = self.function(x * self.scale, xS * self.scale, self.op.weight + self.noise, self.weightS)
-        x, xS = self.function(x, xS, self.op.weight + self.noise, self.weightS)
+        dtype = x.dtype
+        x, xS, weight, weightS = self.to_compute(x, xS, self.op.weight + self.noise, self.weightS)
+        x, xS = self.function(x, xS, weight, weightS)
         x, xS = self.times_function(x, xS, self.scale)
         if self.op.bias is not None:
             x += self.op.bias
         if self.op.bias is not None:
-            xS += self.op.bias
-        return x, xS
+            xS = xS + self.op.bias.to(xS.dtype)
+        # xS stays a placeholder in compute_dtype, only x goes back
+        return x.to(dtype), xS
 
 class SConv2d(SModule):
-    def __init__(self, in_channels, out_channels, kernel_size, stride=1, padding=0, dilation=1, groups=1, bias=True, padding_mode='zeros'):
-        super().__init__()
+    def __init__(self, in_channels, out_channels, kernel_size, stride=1, padding=0, dilation=1, groups=1, bias=True, padding_mode='zeros', compute_dtype=None):
+        super().__init__(compute_dtype)
         self.op = nn.Conv2d(in_channels, out_channels, kernel_size, stride, padding, dilation, groups, bias, padding_mode)
         self.create_helper()
         self.function = SConv2dFunction.apply
         self.times_function = TimesFunction.apply
 
     def copy_N(self):
-        new = NConv2d(self.op.in_channels, self.op.out_channels, self.op.kernel_size, self.op.stride, self.op.padding, self.op.dilation, self.op.groups, False if self.op.bias is None else True, self.op.padding_mode)
+        new = NConv2d(self.op.in_channels, self.op.out_channels, self.op.kernel_size, self.op.stride, self.op.padding, self.op.dilation, self.op.groups, False if self.op.bias is None else True, self.op.padding_mode, self.compute_dtype)
         new.op = self.op
         new.noise = self.noise
         new.mask = self.mask
@@ -188,15 +211,23 @@ class SConv2d(SModule):
     def forward(self, xC):
         x, xS = xC
         # x, xS = self.function(x * self.scale, xS * self.scale, self.op.weight + self.noise, self.weightS, None, self.op.stride, self.op.padding, self.op.dilation, self.op.groups)
-        x, xS = self.function(x, xS, self.op.weight + self.noise, self.weightS, None, self.op.stride, self.op.padding, self.op.dilation, self.op.groups)
+        dtype = x.dtype
+        x, xS, weight, weightS = self.to_compute(x, xS, self.op.weight + self.noise, self.weightS)
+        x, xS = self.function(x, xS, weight, weightS, None, self.op.stride, self.op.padding, self.op.dilation, self.op.groups)
         x, xS = self.times_function(x, xS, self.scale)
         if self.op.bias is not None:
             x += self.op.bias.reshape(1,-1,1,1).expand_as(x)
         if self.op.bias is not None:
-            xS += self.op.bias.reshape(1,-1,1,1).expand_as(xS)
-        return x, xS
+            xS = xS + self.op.bias.reshape(1,-1,1,1).to(xS.dtype).expand_as(xS)
+        # xS stays a placeholder in compute_dtype, only x goes back
+        return x.to(dtype), xS
 
 class NModule(nn.Module):
+    def __init__(self, compute_dtype=None):
+        super().__init__()
+        # not used by the N forward, only carried so copy_S restores it
+        self.compute_dtype = compute_dtype
+
     def set_noise(self, dev_var, write_var, N, m):
         # N: number of bits per weight, m: number of bits per device
         # Dev_var: device variation before write and verify
@@ -222,15 +253,15 @@ class NModule(nn.Module):
         self.noise = self.noise.to(self.op.weight.device)
 
 class NLinear(NModule):
-    def __init__(self, in_features, out_features, bias=True):
-        super().__init__()
+    def __init__(self, in_features, out_features, bias=True, compute_dtype=None):
+        super().__init__(compute_dtype)
         self.op = nn.Linear(in_features, out_features, bias)
         self.noise = torch.zeros_like(self.op.weight)
         self.mask = torch.ones_like(self.op.weight)
         self.function = nn.functional.linear
 
     def copy_S(self):
-        new = SLinear(self.op.in_features, self.op.out_features, False if self.op.bias is None else True)
+        new = SLinear(self.op.in_features, self.op.out_features, False if self.op.bias is None else True, self.compute_dtype)
         new.op = self.op
         new.noise = self.noise
         new.mask = self.mask
@@ -241,15 +272,15 @@ class NLinear(NModule):
         return x
 
 class NConv2d(NModule):
-    def __init__(self, in_channels, out_channels, kernel_size, stride=1, padding=0, dilation=1, groups=1, bias=True, padding_mode='zeros'):
-        super().__init__()
+    def __init__(self, in_channels, out_channels, kernel_size, stride=1, padding=0, dilation=1, groups=1, bias=True, padding_mode='zeros', compute_dtype=None):
+        super().__init__(compute_dtype)
         self.op = nn.Conv2d(in_channels, out_channels, kernel_size, stride, padding, dilation, groups, bias, padding_mode)
         self.noise = torch.zeros_like(self.op.weight)
         self.mask = torch.ones_like(self.op.weight)
         self.function = nn.functional.conv2d
     
     def copy_S(self):
-        new = SConv2d(self.op.in_channels, self.op.out_channels, self.op.kernel_size, self.op.stride, self.op.padding, self.op.dilation, self.op.groups, False if self.op.bias is None else True, self.op.padding_mode)
+        new = SConv2d(self.op.in_channels, self.op.out_channels, self.op.kernel_size, self.op.stride, self.op.padding, self.op.dilation, self.op.groups, False if self.op.bias is None else True, self.op.padding_mode, self.compute_dtype)
         new.op = self.op
         new.noise = self.noise
         new.mask = self.mask
@@ -267,7 +298,7 @@ class SReLU(nn.Module):
     def forward(self, xC):
         x, xS = xC
         with torch.no_grad():
-            mask = (x > 0).to(torch.float)
+            mask = (x > 0).to(x.dtype)
         return self.op(x), xS * mask
 
 class SMaxpool2D(nn.Module):
@@ -311,15 +342,21 @@ class SAvgPool2d(nn.Module):
         return self.op(x), self.op(xS)
 
 class SBatchNorm2d(nn.Module):
-    def __init__(self, num_features, eps=1e-05, momentum=0.1, affine=True, track_running_stats=True):
+    def __init__(self, num_features, eps=1e-05, momentum=0.1, affine=True, track_running_stats=True, compute_dtype=None):
         super().__init__()
         self.op = nn.BatchNorm2d(num_features, eps, momentum, affine, track_running_stats)
+        self.compute_dtype = compute_dtype
         self.function = SBatchNorm2dFunction.apply
     
     def forward(self, xC):
         x, xS = xC
+        # only the activations are cast, running stats and affine params stay in their own dtype
+        dtype = x.dtype
+        if self.compute_dtype is not None:
+            x = x.to(self.compute_dtype)
+            xS = cast_placeholder(xS, x)
         x, xS = self.function(x, xS, self.op.running_mean, self.op.running_var, self.op.weight, self.op.bias, self.op.training, self.op.momentum, self.op.eps)
-        return x, xS
+        return x.to(dtype), xS
 
 class SAct(nn.Module):
     def __init__(self, size):
@@ -383,9 +420,11 @@ class NAct(nn.Module):
         return x + self.noise * self.mask
 
 class FakeSModule(nn.Module):
-    def __init__(self, op):
+    def __init__(self, op, compute_dtype=None):
         super().__init__()
         self.op = op
+        # only carried so back_real restores it
+        self.compute_dtype = compute_dtype
         if isinstance(self.op, nn.MaxPool2d):
             self.op.return_indices = False
     
@@ -545,7 +584,7 @@ class SModel(nn.Module):
     def to_fake(self, device):
         for name, m in self.named_modules():
             if isinstance(m, SModule) or isinstance(m, SMaxpool2D) or isinstance(m, SReLU):
-                new = FakeSModule(m.op)
+                new = FakeSModule(m.op, getattr(m, "compute_dtype", None))
                 self._modules[name] = new
         self.to(device)
     
@@ -569,6 +608,9 @@ class SModel(nn.Module):
                 for i in range(len(n) - 1):
                     father = father._modules[n[i]]
                 father._modules[n[-1]] = m.op
+                if isinstance(m, SBatchNorm2d):
+                    # kept on the plain op so from_first_back_second can restore it
+                    m.op.compute_dtype = m.compute_dtype
                 if isinstance(m, SMaxpool2D):
                     father._modules[n[-1]].return_indices = False
 
@@ -603,7 +645,7 @@ class SModel(nn.Module):
                         new = SAvgPool2d(m.kernel_size, m.stride, m.padding, m.ceil_mode, m.count_include_pad, m.divisor_override)
                         new.op = m
                     elif isinstance(m, nn.BatchNorm2d):
-                        new = SBatchNorm2d(m.num_features)
+                        new = SBatchNorm2d(m.num_features, compute_dtype=getattr(m, "compute_dtype", None))
                         new.op = m
                     # TODO: Other modules specified above
                     father._modules[n[-1]] = new
@@ -647,14 +689,14 @@ class SModel(nn.Module):
                 if isinstance(m.op, nn.Linear):
                     if m.op.bias is not None:
                         bias = True
-                    new = SLinear(m.op.in_features, m.op.out_features, bias)
+                    new = SLinear(m.op.in_features, m.op.out_features, bias, m.compute_dtype)
                     new.op = m.op
                     self._modules[name] = new
 
                 elif isinstance(m.op, nn.Conv2d):
                     if m.op.bias is not None:
                         bias = True
-                    new = SConv2d(m.op.in_channels, m.op.out_channels, m.op.kernel_size, m.op.stride, m.op.padding, m.op.dilation, m.op.groups, bias, m.op.padding_mode)
+                    new = SConv2d(m.op.in_channels, m.op.out_channels, m.op.kernel_size, m.op.stride, m.op.padding, m.op.dilation, m.op.groups, bias, m.op.padding_mode, m.compute_dtype)
                     new.op = m.op
                     self._modules[name] = new
 
@@ -27,7 +27,7 @@ class QSLinear(SModule):
         if self.op.bias is not None:
             x += quant(self.N, self.op.bias)
         if self.op.bias is not None:
-            xS += self.op.bias
+            xS = xS + self.op.bias
         return quant(self.N, x), xS
 
 class QSConv2d(SModule):
@@ -51,7 +51,7 @@ class QSConv2d(SModule):
         if self.op.bias is not None:
             x += quant(self.N, self.op.bias).reshape(1,-1,1,1).expand_as(x)
         if self.op.bias is not None:
-            xS += self.op.bias.reshape(1,-1,1,1).expand_as(xS)
+            xS = xS + self.op.bias.reshape(1,-1,1,1).expand_as(xS)
         # x, xS = self.function(x * self.scale, xS * self.scale, quant(self.N, self.op.weight) + self.noise, self.weightS, self.op.bias, self.op.stride, self.op.padding, self.op.dilation, self.op.groups)
         return quant(self.N, x), xS
 
@@ -71,7 +71,7 @@ class BasicBlock(SModel):
             out, outS = out
             identity, identityS = identity
             out += identity
-            outS += identityS
+            outS = outS + identityS
             out = self.relu((out, outS))
         else:
             out += identity
@@ -136,7 +136,7 @@ class Bottleneck(SModel):
             out, outS = out
             identity, identityS = identity
             out += identity
-            outS += identityS
+            outS = outS + identityS
             out = self.relu((out, outS))
         else:
             out += identity
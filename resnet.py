@@ -69,7 +69,7 @@ class BasicBlock(SModel):
             out, outS = out
             identity, identityS = identity
             out += identity
-            outS += identityS
+            outS = outS + identityS
             out = self.relu((out, outS))
         else:
             out += identity
@@ -133,7 +133,7 @@ class Bottleneck(SModel):
             out, outS = out
             identity, identityS = identity
             out += identity
-            outS += identityS
+            outS = outS + identityS
             out = self.relu((out, outS))
         else:
             out += identity